@@ -8,3 +8,4 @@ if __name__ == "__main__":
 
     app = ImageViewer()
     app.mainloop()
+    app.close()
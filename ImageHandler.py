@@ -1,7 +1,9 @@
 from __future__ import annotations
-from typing import Optional
+from typing import Optional, Callable
 import io
 import os
+import re
+import errno
 import sys
 import glob
 import rawpy
@@ -10,6 +12,7 @@ import fractions
 from datetime import datetime
 from PIL import Image
 from CTkMessagebox import CTkMessagebox
+from Journal import Journal, JournalOp, norm_path, read_ops
 
 
 def disp_error(msg: str, exit_after: bool = False):
@@ -132,9 +135,67 @@ def no_ext_fname(path: str) -> str:
     return ".".join(os.path.basename(path).split(".")[:-1])
 
 
+def mv_no_replace(src_file: str, dest_file: str):
+    if os.name == "nt":
+        # never replaces an existing file on Windows
+        os.rename(src_file, dest_file)
+        return
+
+    try:
+        os.link(src_file, dest_file)
+    except FileExistsError:
+        raise
+    except OSError:
+        # no hard links on this filesystem (e.g. exFAT)
+        if os.path.lexists(dest_file):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dest_file)
+        os.rename(src_file, dest_file)
+        return
+    os.unlink(src_file)
+
+
+def sort_key(img_obj: ImageObject) -> str:
+    return min(os.path.basename(f) for f in (img_obj.jpg_file, img_obj.nef_file) if f is not None)
+
+
+class DestNameIndex:
+    def __init__(self, folders: list):
+        self._names = {norm_path(folder): {os.path.normcase(f) for f in os.listdir(folder)} for folder in folders}
+        self._next_suffix = {}
+
+    def reserve(self, path: str):
+        self._names.setdefault(norm_path(os.path.dirname(path)), set()).add(os.path.normcase(os.path.basename(path)))
+
+    def release(self, path: str):
+        folder, name = norm_path(os.path.dirname(path)), os.path.normcase(os.path.basename(path))
+        self._names.get(folder, set()).discard(name)
+
+        # hand the freed slot out again, otherwise every undo/redo cycle bumps the suffix
+        m = re.match(r"^(.*?)(?:\((\d+)\))?\.([^.]*)$", name)
+        if m is not None:
+            key = (folder, m.group(1), m.group(3))
+            if key in self._next_suffix:
+                self._next_suffix[key] = min(self._next_suffix[key], int(m.group(2) or 1))
+
+    def alloc(self, dest_folder: str, stem: str, ext: str) -> str:
+        names = self._names.setdefault(norm_path(dest_folder), set())
+        key = (norm_path(dest_folder), os.path.normcase(stem), os.path.normcase(ext))
+        i = self._next_suffix.get(key, 1)
+
+        while True:
+            new_filename = f"{stem}.{ext}" if i <= 1 else f"{stem}({i}).{ext}"
+            i += 1
+            if os.path.normcase(new_filename) not in names:
+                break
+
+        self._next_suffix[key] = i
+        names.add(os.path.normcase(new_filename))
+        return os.path.join(dest_folder, new_filename)
+
+
 class ImageHandler:
     def __init__(self, nef_folder="./NEF", jpg_folder="./JPG", opt_nef_folder="./SEL_NEF", opt_jpg_folder="./SEL_JPG",
-                 del_folder="./DEL"):
+                 del_folder="./DEL", journal_file="./journal.jsonl", resume=False):
         nef_files = [f for f in glob.glob(os.path.join(nef_folder, '*')) if is_nef_file(f)]
         jpg_files = [f for f in glob.glob(os.path.join(jpg_folder, '*')) if is_jpg_file(f)]
         os.makedirs(opt_jpg_folder, exist_ok=True)
@@ -146,6 +207,23 @@ class ImageHandler:
         self._opt_nef_folder = opt_nef_folder
         self._opt_jpg_folder = opt_jpg_folder
         self._del_folder = del_folder
+        self._curr = None
+        self._dest_index = DestNameIndex([opt_nef_folder, opt_jpg_folder, del_folder])
+        if not resume and Journal.has_history(journal_file):
+            # a new session drops the old ops, but a crash between link and unlink must not leave the file twice
+            for journal_op in read_ops(journal_file)[0]:
+                for src_file, dest_file in journal_op.pending_moves():
+                    if os.path.exists(src_file) and os.path.exists(dest_file) and os.path.samefile(src_file, dest_file):
+                        os.unlink(src_file)
+        self._journal = Journal(journal_file, resume)
+
+        for journal_op in self._journal.ops():
+            for _, dest in journal_op.moves:
+                self._dest_index.reserve(dest)
+
+        for journal_op in self._journal.pending_ops():
+            print(f"Replaying interrupted {journal_op.op} of {', '.join(src for src, _ in journal_op.moves)}.")
+            self._run_moves(journal_op, replay=True)
 
         all_files = sorted(nef_files + jpg_files, key=lambda x: os.path.basename(x))
         self._org_size = 0
@@ -206,6 +284,18 @@ class ImageHandler:
     def curr_img(self) -> Optional[ImageObject, None]:
         return self._curr
 
+    def imgs(self) -> list:
+        imgs = []
+        node = self._head
+        while node is not None:
+            imgs.append(node)
+            node = node.next
+        return imgs
+
+    def select_img(self, img_obj: ImageObject) -> ImageObject:
+        self._curr = img_obj
+        return self._curr
+
     def has_next(self) -> bool:
         return self._curr is not None and self._curr.next is not None
 
@@ -224,81 +314,183 @@ class ImageHandler:
             self._curr = self._curr.prev
         return self._curr
 
-    def _rename_mv(self, src_file: str, dest_folder: str):
+    def close(self):
+        self._journal.close()
+
+    def can_undo(self) -> bool:
+        return self._journal.last_op() is not None
+
+    def _alloc_dest(self, src_file: str, dest_folder: str) -> str:
+        ext = src_file.split('.')[-1]
+        if 'date' in self._curr.meta and self._curr.meta['date']:
+            return self._dest_index.alloc(dest_folder, f"IMG_{self._curr.meta['date'].strftime('%y%m%d_%H%M%S')}", ext)
+        return self._dest_index.alloc(dest_folder, no_ext_fname(src_file), ext)
+
+    @staticmethod
+    def _rename_mv(src_file: str, dest_file: str, realloc: Callable[[str], str] = None) -> bool:
         while True:
             try:
-                if 'date' in self._curr.meta and self._curr.meta['date']:
-                    success = False
-                    for i in range(1, 50):
-                        if i <= 1:
-                            new_filename = f"IMG_{self._curr.meta['date'].strftime('%y%m%d_%H%M%S')}.{src_file.split('.')[-1]}"
-                        else:
-                            new_filename = f"IMG_{self._curr.meta['date'].strftime('%y%m%d_%H%M%S')}({i}).{src_file.split('.')[-1]}"
-
-                        if os.path.exists(os.path.join(dest_folder, new_filename)):
-                            continue
-
-                        os.rename(src_file, os.path.join(dest_folder, new_filename))
-                        success = True
-                        break
-
-                    if not success:
-                        os.rename(src_file, dest_folder)
-                else:
-                    os.rename(src_file, dest_folder)
-
-                break
-            except Exception as e:
-                msg = CTkMessagebox(title="Error",
-                                    message=f"Unable to move file {src_file} to {dest_folder}.\n{str(e)}",
-                                    option_1="Skip", option_2="Retry", icon="cancel")
-                if msg.get() == "Retry":
+                mv_no_replace(src_file, dest_file)
+                return True
+            except FileExistsError as e:
+                if realloc is not None:
+                    dest_file = realloc(dest_file)
                     continue
-                else:
-                    break
+                err = e
+            except Exception as e:
+                err = e
+
+            msg = CTkMessagebox(title="Error",
+                                message=f"Unable to move file {src_file} to {dest_file}.\n{str(err)}",
+                                option_1="Skip", option_2="Retry", icon="cancel")
+            if msg.get() != "Retry":
+                return False
+
+    def _realloc_dest(self, journal_op: JournalOp, src_file: str, dest_file: str) -> str:
+        # the name was taken after the index was built, journal a fresh one before moving
+        self._dest_index.reserve(dest_file)
+        new_dest = self._dest_index.alloc(os.path.dirname(dest_file), re.sub(r"\(\d+\)$", "", no_ext_fname(dest_file)),
+                                          dest_file.split('.')[-1])
+        self._journal.log_dest(journal_op, src_file, new_dest)
+        return new_dest
+
+    def _recover_move(self, journal_op: JournalOp, src_file: str, dest_file: str) -> bool:
+        if not os.path.exists(src_file) and os.path.exists(dest_file):
+            # moved before the crash but not yet journaled
+            self._journal.log_move(journal_op, src_file)
+        elif os.path.exists(dest_file) and os.path.samefile(src_file, dest_file):
+            # crashed between linking the destination and unlinking the source
+            os.unlink(src_file)
+            self._journal.log_move(journal_op, src_file)
+        elif not os.path.exists(src_file):
+            # the source vanished outside of the app, nothing left to move
+            self._journal.log_skip(journal_op, src_file)
+        else:
+            return False
+        return True
+
+    def _run_moves(self, journal_op: JournalOp, replay: bool = False):
+        for src_file, dest_file in journal_op.pending_moves():
+            if replay and self._recover_move(journal_op, src_file, dest_file):
+                continue
+
+            if self._rename_mv(src_file, dest_file, lambda dest: self._realloc_dest(journal_op, src_file, dest)):
+                self._journal.log_move(journal_op, src_file)
+            else:
+                # the file stays in the source folder and is shown again as undecided
+                self._journal.log_skip(journal_op, src_file)
+
+    def _apply_op(self, op: str, moves: list):
+        assert self._curr is not None
+        self._curr.close()
+        journal_op = self._journal.log_op(op, [(src_file, self._alloc_dest(src_file, dest_folder))
+                                               for src_file, dest_folder in moves])
+        self._run_moves(journal_op)
+        self._remove_curr()
 
     def op_keep_jpg(self):
         assert self._curr is not None
         assert self._curr.has_jpg()
-        self._curr.close()
-        self._rename_mv(self._curr.jpg_file, self._opt_jpg_folder)
+        moves = [(self._curr.jpg_file, self._opt_jpg_folder)]
         if self._curr.has_nef():
-            self._rename_mv(self._curr.nef_file, self._del_folder)
-        self._remove_curr()
+            moves.append((self._curr.nef_file, self._del_folder))
+        self._apply_op("keep_jpg", moves)
 
     def op_keep_nef(self):
         assert self._curr is not None
         assert self._curr.has_nef()
-        self._curr.close()
-        self._rename_mv(self._curr.nef_file, self._opt_nef_folder)
+        moves = [(self._curr.nef_file, self._opt_nef_folder)]
         if self._curr.has_jpg():
-            self._rename_mv(self._curr.jpg_file, self._del_folder)
-        self._remove_curr()
+            moves.append((self._curr.jpg_file, self._del_folder))
+        self._apply_op("keep_nef", moves)
 
     def op_del_both(self):
         assert self._curr is not None
-        self._curr.close()
+        moves = []
         if self._curr.has_nef():
-            self._rename_mv(self._curr.nef_file, self._del_folder)
+            moves.append((self._curr.nef_file, self._del_folder))
         if self._curr.has_jpg():
-            self._rename_mv(self._curr.jpg_file, self._del_folder)
-        self._remove_curr()
+            moves.append((self._curr.jpg_file, self._del_folder))
+        self._apply_op("del_both", moves)
+
+    def undo(self, n: int = 1) -> Optional[ImageObject]:
+        restored = None
+        for _ in range(n):
+            journal_op = self._journal.last_op()
+            if journal_op is None:
+                break
 
-    def _remove_curr(self) -> Optional[ImageObject]:
-        assert self._curr is not None
-        aft = self._curr.next if self._curr.next is not None else self._curr.prev
+            reverted = True
+            for src_file, dest_file in journal_op.moves:
+                if src_file not in journal_op.done:
+                    self._dest_index.release(dest_file)
+                elif self._rename_mv(dest_file, src_file):
+                    self._dest_index.release(dest_file)
+                    self._journal.log_skip(journal_op, src_file)
+                else:
+                    reverted = False
+
+            if reverted:
+                self._journal.log_undo(journal_op)
+
+            jpg_file = next((f for f, _ in journal_op.moves if is_jpg_file(f) and os.path.isfile(f)), None)
+            nef_file = next((f for f, _ in journal_op.moves if is_nef_file(f) and os.path.isfile(f)), None)
+            if jpg_file is not None or nef_file is not None:
+                # a skipped move left its file in the list, merge it with the restored ones instead of adding it twice
+                op_files = {norm_path(f) for f in (jpg_file, nef_file) if f is not None}
+                for node in self.imgs():
+                    if op_files & {norm_path(f) for f in (node.jpg_file, node.nef_file) if f is not None}:
+                        self._unlink(node)
+                        node.close()
+
+                img_obj = ImageObject(nef_file=nef_file, jpg_file=jpg_file)
+                if img_obj.is_valid():
+                    self._insert(img_obj)
+                    restored = img_obj
+
+            if not reverted:
+                # the files still in the destination keep the op undoable, stop before older ops
+                break
 
-        if self._curr == self._head:
-            self._head = self._curr.next
+        if restored is not None:
+            self._curr = restored
+        return restored
 
-        if self._curr.prev is not None:
-            self._curr.prev.next = self._curr.next
+    def _insert(self, img_obj: ImageObject):
+        key = sort_key(img_obj)
+        prev, node = None, self._head
+        while node is not None and sort_key(node) <= key:
+            prev, node = node, node.next
 
-        if self._curr.next is not None:
-            self._curr.next.prev = self._curr.prev
+        img_obj.prev = prev
+        img_obj.next = node
+        if prev is not None:
+            prev.next = img_obj
+        else:
+            self._head = img_obj
+        if node is not None:
+            node.prev = img_obj
+        self._curr_size += 1
 
-        self._curr.prev = None
-        self._curr.next = None
-        self._curr = aft
+    def _unlink(self, img_obj: ImageObject) -> Optional[ImageObject]:
+        aft = img_obj.next if img_obj.next is not None else img_obj.prev
+
+        if img_obj == self._head:
+            self._head = img_obj.next
+
+        if img_obj.prev is not None:
+            img_obj.prev.next = img_obj.next
+
+        if img_obj.next is not None:
+            img_obj.next.prev = img_obj.prev
+
+        img_obj.prev = None
+        img_obj.next = None
+        if img_obj == self._curr:
+            self._curr = aft
         self._curr_size -= 1
         return aft
+
+    def _remove_curr(self) -> Optional[ImageObject]:
+        assert self._curr is not None
+        return self._unlink(self._curr)
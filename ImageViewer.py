@@ -23,15 +23,29 @@ import customtkinter as ctk
 from PIL import Image, ImageTk
 from CTkMessagebox import CTkMessagebox
 from ImageHandler import ImageHandler, ImageObject
+from Journal import Journal
+from ThumbGrid import ThumbGrid, PreviewCache
 
 
 class ImageViewer(ctk.CTk):
     def __init__(self, nef_folder="./NEF", jpg_folder="./JPG", opt_nef_folder="./SEL_NEF", opt_jpg_folder="./SEL_JPG",
-                 del_folder="./DEL"):
+                 del_folder="./DEL", journal_file="./journal.jsonl"):
         super().__init__()
 
+        resume = False
+        if Journal.has_history(journal_file):
+            pending = Journal.pending_count(journal_file)
+            message = f"Found the decision journal of a previous session in {journal_file}. Resume it?"
+            if pending:
+                message += f"\n{pending} decision(s) were interrupted and are only completed when resuming."
+            message += f"\nA new session keeps the old journal as {Journal.rotated_path(journal_file)}."
+            msg = CTkMessagebox(title="Resume Session", message=message, icon="question", option_1="New Session",
+                                option_2="Resume")
+            resume = msg.get() == "Resume"
+
         print("Reading all images ...")
-        self.img_it = ImageHandler(nef_folder, jpg_folder, opt_nef_folder, opt_jpg_folder, del_folder)
+        self.img_it = ImageHandler(nef_folder, jpg_folder, opt_nef_folder, opt_jpg_folder, del_folder, journal_file,
+                                   resume)
 
         if not self.img_it.curr_img():
             msg = CTkMessagebox(title="Error",
@@ -75,23 +89,32 @@ class ImageViewer(ctk.CTk):
                                          state=ctk.DISABLED)
         self.button_prev.grid(row=0, column=0, padx=20, pady=20, sticky="w")
 
+        self.button_undo = ctk.CTkButton(frame_ctrl, text="Undo", anchor=ctk.CENTER, command=self.undo,
+                                         state=ctk.DISABLED)
+        self.button_undo.grid(row=0, column=1, padx=20, pady=20, sticky="we")
+
         self.button_del_both = ctk.CTkButton(frame_ctrl, text="Remove", anchor=ctk.CENTER, command=self.del_both,
                                              state=ctk.DISABLED)
-        self.button_del_both.grid(row=0, column=1, padx=20, pady=20, sticky="we")
+        self.button_del_both.grid(row=0, column=2, padx=20, pady=20, sticky="we")
 
         self.button_keep_jpg = ctk.CTkButton(frame_ctrl, text="Keep JPG", anchor=ctk.CENTER, command=self.keep_jpg,
                                              state=ctk.DISABLED)
-        self.button_keep_jpg.grid(row=0, column=2, padx=20, pady=20, sticky="we")
+        self.button_keep_jpg.grid(row=0, column=3, padx=20, pady=20, sticky="we")
 
         self.button_keep_nef = ctk.CTkButton(frame_ctrl, text="Keep NEF", anchor=ctk.CENTER, command=self.keep_nef,
                                              state=ctk.DISABLED)
-        self.button_keep_nef.grid(row=0, column=3, padx=20, pady=20, sticky="we")
+        self.button_keep_nef.grid(row=0, column=4, padx=20, pady=20, sticky="we")
 
         self.button_next = ctk.CTkButton(frame_ctrl, text=">> Next", anchor=ctk.E, command=self.show_next,
                                          state=ctk.NORMAL)
-        self.button_next.grid(row=0, column=4, padx=20, pady=20, sticky="e")
+        self.button_next.grid(row=0, column=5, padx=20, pady=20, sticky="e")
+
+        self.button_grid = ctk.CTkButton(frame_ctrl, text="Grid", anchor=ctk.CENTER, command=self.show_grid,
+                                         state=ctk.NORMAL)
+        self.button_grid.grid(row=0, column=6, padx=20, pady=20, sticky="e")
 
         frame_ctrl.pack(side=ctk.BOTTOM, fill=ctk.X)
+        self.frame_ctrl = frame_ctrl
 
         # ステータスバー相当(親に追加)
         frame_statusbar = ctk.CTkFrame(self, corner_radius=0, fg_color="transparent")
@@ -100,17 +123,24 @@ class ImageViewer(ctk.CTk):
         self.label_image_info.pack(side=ctk.RIGHT)
         self.label_image_pixel.pack(side=ctk.LEFT)
         frame_statusbar.pack(side=ctk.BOTTOM, fill=ctk.X)
+        self.frame_statusbar = frame_statusbar
 
         # Canvas
         self.canvas = ctk.CTkCanvas(self, background="black")
         self.canvas.pack(expand=True, fill=ctk.BOTH)  # この両方でDock.Fillと同じ
 
+        # Contact sheet, shown in place of the canvas
+        self.preview_cache = PreviewCache()
+        self.grid_view = ThumbGrid(self, self.img_it, self.preview_cache, on_open=self.show_viewer,
+                                   on_close=self.show_viewer, on_undo=self.undo)
+
         # マウスイベント
         self.bind("<Button-1>", self.mouse_down_left)  # MouseDown
         self.bind("<B1-Motion>", self.mouse_move_left)  # MouseDrag（ボタンを押しながら移動）
         self.bind("<Motion>", self.mouse_move)  # MouseMove
         self.bind("<Double-Button-1>", self.mouse_double_click_left)  # MouseDoubleClick
         self.bind("<MouseWheel>", self.mouse_wheel)  # MouseWheel
+        self.bind("<Control-z>", lambda event: self.undo())
 
     def show_prev(self):
         self.set_image(self.img_it.prev_img())
@@ -120,6 +150,24 @@ class ImageViewer(ctk.CTk):
         self.set_image(self.img_it.next_img())
         self.update_buttons()
 
+    def show_grid(self):
+        self.pil_image = None
+        self.frame_ctrl.pack_forget()
+        self.canvas.pack_forget()
+        self.grid_view.pack(expand=True, fill=ctk.BOTH)
+        self.update_idletasks()
+        self.grid_view.show()
+
+    def show_viewer(self, img_obj: ImageObject = None):
+        self.grid_view.hide()
+        self.grid_view.pack_forget()
+        self.frame_ctrl.pack(side=ctk.BOTTOM, fill=ctk.X, before=self.frame_statusbar)
+        self.canvas.pack(expand=True, fill=ctk.BOTH)
+        self.update_idletasks()
+        if img_obj is not None:
+            self.img_it.select_img(img_obj)
+        self._prog_or_exit_no_img()
+
     def _prog_or_exit_no_img(self):
         if self.img_it.curr_img() is None:
             msg = CTkMessagebox(title="Info", message="No image left! Exiting ...", icon="info")
@@ -145,7 +193,27 @@ class ImageViewer(ctk.CTk):
         self.img_it.op_del_both()
         self._prog_or_exit_no_img()
 
+    def undo(self):
+        if not self.img_it.can_undo():
+            return
+        restored = self.img_it.undo()
+        if self.grid_view.winfo_ismapped():
+            self.grid_view.reload()
+            return
+        if restored is not None:
+            self.set_image(self.img_it.curr_img())
+        self.update_buttons()
+
+    def close(self):
+        self.preview_cache.close()
+        self.img_it.close()
+
     def update_buttons(self):
+        if not self.img_it.can_undo():
+            self.button_undo.configure(state=ctk.DISABLED)
+        else:
+            self.button_undo.configure(state=ctk.NORMAL)
+
         if not self.img_it.has_prev():
             self.button_prev.configure(state=ctk.DISABLED)
         else:
@@ -0,0 +1,138 @@
+from __future__ import annotations
+from typing import Optional
+import os
+import json
+
+
+def norm_path(path: str) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+class JournalOp:
+    def __init__(self, op_id: int, op: str, moves: list):
+        self.op_id = op_id
+        self.op = op
+        self.moves = [(src, dest) for src, dest in moves]
+        self.done = set()
+        self.skipped = set()
+
+    def is_complete(self) -> bool:
+        return len(self.done | self.skipped) == len(self.moves)
+
+    def retarget(self, src: str, dest: str):
+        self.moves = [(s, dest if s == src else d) for s, d in self.moves]
+
+    def pending_moves(self) -> list:
+        return [(src, dest) for src, dest in self.moves if src not in self.done and src not in self.skipped]
+
+
+def read_ops(path: str) -> tuple:
+    ops = {}
+    next_id = 1
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+            if rec["t"] == "op":
+                ops[rec["id"]] = JournalOp(rec["id"], rec["op"], rec["moves"])
+                next_id = max(next_id, rec["id"] + 1)
+            elif rec["t"] == "mv" and rec["id"] in ops:
+                ops[rec["id"]].done.add(rec["src"])
+            elif rec["t"] == "dest" and rec["id"] in ops:
+                ops[rec["id"]].retarget(rec["src"], rec["dest"])
+            elif rec["t"] == "skip" and rec["id"] in ops:
+                ops[rec["id"]].done.discard(rec["src"])
+                ops[rec["id"]].skipped.add(rec["src"])
+            elif rec["t"] == "undo":
+                ops.pop(rec["id"], None)
+
+    return sorted(ops.values(), key=lambda x: x.op_id), next_id
+
+
+class Journal:
+    """ Append-only log of decisions; an op is written with its planned destinations before any file is moved """
+
+    def __init__(self, path: str, resume: bool = False):
+        self._path = path
+        self._ops = []
+        self._next_id = 1
+
+        if resume and os.path.isfile(path):
+            self._load()
+        elif self.has_history(path):
+            # keep every previous session around instead of truncating it
+            os.rename(path, self.rotated_path(path))
+
+        self._fp = open(path, "a", encoding="utf-8")
+        if resume and self._fp.tell() > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # the last record was cut off by a crash, terminate it so new records stay parseable
+                    self._fp.write("\n")
+                    self._fp.flush()
+
+    @staticmethod
+    def has_history(path: str) -> bool:
+        return os.path.isfile(path) and os.path.getsize(path) > 0
+
+    @staticmethod
+    def rotated_path(path: str) -> str:
+        i = 1
+        while os.path.exists(f"{path}.{i}"):
+            i += 1
+        return f"{path}.{i}"
+
+    @staticmethod
+    def pending_count(path: str) -> int:
+        return len([op for op in read_ops(path)[0] if not op.is_complete()])
+
+    def _load(self):
+        self._ops, self._next_id = read_ops(self._path)
+
+    def _append(self, rec: dict):
+        self._fp.write(json.dumps(rec) + "\n")
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def log_op(self, op: str, moves: list) -> JournalOp:
+        journal_op = JournalOp(self._next_id, op, moves)
+        self._next_id += 1
+        self._append({"t": "op", "id": journal_op.op_id, "op": op, "moves": journal_op.moves})
+        self._ops.append(journal_op)
+        return journal_op
+
+    def log_move(self, journal_op: JournalOp, src: str):
+        self._append({"t": "mv", "id": journal_op.op_id, "src": src})
+        journal_op.done.add(src)
+
+    def log_dest(self, journal_op: JournalOp, src: str, dest: str):
+        self._append({"t": "dest", "id": journal_op.op_id, "src": src, "dest": dest})
+        journal_op.retarget(src, dest)
+
+    def log_skip(self, journal_op: JournalOp, src: str):
+        # also records a move reverted by a partial undo, the file is back in its source folder
+        self._append({"t": "skip", "id": journal_op.op_id, "src": src})
+        journal_op.done.discard(src)
+        journal_op.skipped.add(src)
+
+    def log_undo(self, journal_op: JournalOp):
+        self._append({"t": "undo", "id": journal_op.op_id})
+        self._ops.remove(journal_op)
+
+    def ops(self) -> list:
+        return list(self._ops)
+
+    def pending_ops(self) -> list:
+        return [op for op in self._ops if not op.is_complete()]
+
+    def last_op(self) -> Optional[JournalOp]:
+        return self._ops[-1] if self._ops else None
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
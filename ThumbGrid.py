@@ -0,0 +1,326 @@
+from __future__ import annotations
+from typing import Optional, Callable
+import io
+import queue
+import threading
+import rawpy
+import customtkinter as ctk
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageTk
+from CTkMessagebox import CTkMessagebox
+from ImageHandler import ImageHandler, ImageObject, no_ext_fname
+
+TILE_PAD = 8
+LABEL_HEIGHT = 18
+
+
+def load_preview(img_obj: ImageObject, size: int) -> Image.Image:
+    if img_obj.has_jpg():
+        src = Image.open(img_obj.jpg_file)
+    else:
+        with rawpy.imread(img_obj.nef_file) as raw:
+            thumb = raw.extract_thumb()
+        if thumb.format == rawpy.ThumbFormat.JPEG:
+            src = Image.open(io.BytesIO(thumb.data))
+        else:
+            src = Image.fromarray(thumb.data)
+
+    with src:
+        # let the JPEG decoder scale down by DCT instead of decoding the full resolution image
+        src.draft("RGB", (size, size))
+        src.thumbnail((size, size))
+        preview = Image.new("RGB", (size, size))
+        preview.paste(src.convert("RGB"), ((size - src.width) // 2, (size - src.height) // 2))
+    return preview
+
+
+class PreviewCache:
+    def __init__(self, size: int = 160, capacity: int = 512, workers: int = 4):
+        self.size = size
+        self._capacity = capacity
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preview")
+        # only touched from the Tk thread
+        self._futures = {}
+        self._done = queue.SimpleQueue()
+
+    def get(self, img_obj: ImageObject) -> Optional[Image.Image]:
+        with self._lock:
+            preview = self._cache.get(img_obj.filename)
+            if preview is not None:
+                self._cache.move_to_end(img_obj.filename)
+            return preview
+
+    def request(self, img_obj: ImageObject):
+        key = img_obj.filename
+        if key in self._futures:
+            return
+        with self._lock:
+            if key in self._cache:
+                return
+        self._futures[key] = self._pool.submit(self._load, img_obj, key)
+
+    def _load(self, img_obj: ImageObject, key: str):
+        try:
+            preview = load_preview(img_obj, self.size)
+        except Exception as e:
+            print(f"Unable to load preview of {key}: {str(e)}")
+            preview = Image.new("RGB", (self.size, self.size), "gray")
+
+        with self._lock:
+            self._cache[key] = preview
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._capacity:
+                self._cache.popitem(last=False)
+        self._done.put(key)
+
+    def cancel_except(self, keys: set):
+        for key, future in list(self._futures.items()):
+            if key not in keys and future.cancel():
+                del self._futures[key]
+
+    def wait(self, keys: set = None):
+        # release the files of these items (all in flight by default), a running decode still holds its source open
+        for key in list(self._futures) if keys is None else keys:
+            future = self._futures.get(key)
+            if future is None:
+                continue
+            if future.cancel():
+                del self._futures[key]
+            else:
+                future.exception()
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def poll(self) -> list:
+        keys = []
+        while True:
+            try:
+                key = self._done.get_nowait()
+            except queue.Empty:
+                return keys
+            self._futures.pop(key, None)
+            keys.append(key)
+
+
+class Tile:
+    def __init__(self, canvas: ctk.CTkCanvas, size: int):
+        self.index = None
+        self.key = None
+        self.photo = ImageTk.PhotoImage("RGB", (size, size))
+        self.rect_id = canvas.create_rectangle(0, 0, 0, 0, outline="", width=3, state=ctk.HIDDEN)
+        self.image_id = canvas.create_image(0, 0, anchor="nw", image=self.photo, state=ctk.HIDDEN)
+        self.text_id = canvas.create_text(0, 0, anchor="n", fill="white", state=ctk.HIDDEN)
+
+
+class ThumbGrid(ctk.CTkFrame):
+    def __init__(self, master, img_it: ImageHandler, cache: PreviewCache, on_open: Callable[[ImageObject], None],
+                 on_close: Callable[[], None], on_undo: Callable[[], None]):
+        super().__init__(master, corner_radius=0, fg_color="transparent")
+        self._img_it = img_it
+        self._cache = cache
+        self._on_open = on_open
+        self._on_close = on_close
+        self._on_undo = on_undo
+        self._tile_w = cache.size + 2 * TILE_PAD
+        self._tile_h = cache.size + 2 * TILE_PAD + LABEL_HEIGHT
+
+        self._items = []
+        self._index = {}
+        self._selected = set()
+        self._anchor = None
+        self._cols = 0
+        self._tiles = {}  # visible item index -> Tile
+        self._free = []  # recycled tiles, reused as others scroll into view
+        self._poll_job = None
+
+        frame_tool = ctk.CTkFrame(self, corner_radius=0, fg_color="transparent")
+        ctk.CTkButton(frame_tool, text="<< Viewer", command=self._on_close).pack(side=ctk.LEFT, padx=20, pady=10)
+        self.button_undo = ctk.CTkButton(frame_tool, text="Undo", command=self._on_undo)
+        self.button_undo.pack(side=ctk.LEFT, padx=20, pady=10)
+        ctk.CTkButton(frame_tool, text="Keep NEF", command=lambda: self._bulk("op_keep_nef")).pack(
+            side=ctk.RIGHT, padx=20, pady=10)
+        ctk.CTkButton(frame_tool, text="Keep JPG", command=lambda: self._bulk("op_keep_jpg")).pack(
+            side=ctk.RIGHT, padx=20, pady=10)
+        ctk.CTkButton(frame_tool, text="Remove", command=lambda: self._bulk("op_del_both")).pack(
+            side=ctk.RIGHT, padx=20, pady=10)
+        self.label_sel = ctk.CTkLabel(frame_tool, text="", padx=5)
+        self.label_sel.pack(side=ctk.LEFT)
+        frame_tool.pack(side=ctk.TOP, fill=ctk.X)
+
+        self.canvas = ctk.CTkCanvas(self, background="black", highlightthickness=0, yscrollincrement=20)
+        self.scrollbar = ctk.CTkScrollbar(self, command=self._yview)
+        self.canvas.configure(yscrollcommand=self.scrollbar.set)
+        self.scrollbar.pack(side=ctk.RIGHT, fill=ctk.Y)
+        self.canvas.pack(expand=True, fill=ctk.BOTH)
+
+        self.canvas.bind("<Configure>", lambda event: self._refresh())
+        self.canvas.bind("<Button-1>", self._click)
+        self.canvas.bind("<Double-Button-1>", self._double_click)
+        self.canvas.bind("<MouseWheel>", lambda event: self._scroll(-1 if event.delta > 0 else 1))
+        self.canvas.bind("<Button-4>", lambda event: self._scroll(-1))
+        self.canvas.bind("<Button-5>", lambda event: self._scroll(1))
+
+    def show(self):
+        self.reload()
+        if self._poll_job is None:
+            self._poll()
+
+    def hide(self):
+        if self._poll_job is not None:
+            self.after_cancel(self._poll_job)
+            self._poll_job = None
+        # the viewer may move any of these files right away
+        self._cache.wait()
+
+    def reload(self):
+        self._items = self._img_it.imgs()
+        self._index = {img_obj: i for i, img_obj in enumerate(self._items)}
+        self._selected &= set(self._items)
+        self._anchor = None
+        for index in list(self._tiles):
+            self._recycle(index)
+        self._cols = 0
+        self._refresh()
+
+    # -------------------------------------------------------------------------------
+    # Virtualized layout
+    # -------------------------------------------------------------------------------
+
+    def _yview(self, *args):
+        self.canvas.yview(*args)
+        self._refresh()
+
+    def _scroll(self, units: int):
+        self.canvas.yview_scroll(units * 3, "units")
+        self._refresh()
+
+    def _refresh(self):
+        cols = max(1, self.canvas.winfo_width() // self._tile_w)
+        if cols != self._cols:
+            self._cols = cols
+            rows = (len(self._items) + cols - 1) // cols
+            self.canvas.configure(scrollregion=(0, 0, cols * self._tile_w, max(rows * self._tile_h, 1)))
+            for index in list(self._tiles):
+                self._recycle(index)
+
+        top = self.canvas.canvasy(0)
+        first_row = int(top // self._tile_h)
+        last_row = int((top + self.canvas.winfo_height()) // self._tile_h)
+        visible = range(first_row * cols, min(len(self._items), (last_row + 1) * cols))
+
+        for index in list(self._tiles):
+            if index not in visible:
+                self._recycle(index)
+        for index in visible:
+            self._place(index)
+
+        self._cache.cancel_except({self._items[i].filename for i in visible})
+        self.label_sel.configure(text=f"{len(self._items)} images  |  {len(self._selected)} selected")
+        self.button_undo.configure(state=ctk.NORMAL if self._img_it.can_undo() else ctk.DISABLED)
+
+    def _recycle(self, index: int):
+        tile = self._tiles.pop(index)
+        tile.index = None
+        for item_id in (tile.rect_id, tile.image_id, tile.text_id):
+            self.canvas.itemconfigure(item_id, state=ctk.HIDDEN)
+        self._free.append(tile)
+
+    def _place(self, index: int):
+        img_obj = self._items[index]
+        tile = self._tiles.get(index)
+        if tile is None:
+            tile = self._free.pop() if self._free else Tile(self.canvas, self._cache.size)
+            self._tiles[index] = tile
+
+        if tile.index != index:
+            tile.index = index
+            x = (index % self._cols) * self._tile_w
+            y = (index // self._cols) * self._tile_h
+            self.canvas.coords(tile.rect_id, x + 2, y + 2, x + self._tile_w - 2, y + self._tile_h - 2)
+            self.canvas.coords(tile.image_id, x + TILE_PAD, y + TILE_PAD)
+            self.canvas.coords(tile.text_id, x + self._tile_w // 2, y + TILE_PAD + self._cache.size + 2)
+            caption = f"[{img_obj.mode.replace(' ONLY', '').replace(' ', '')}] " \
+                      f"{no_ext_fname(img_obj.jpg_file if img_obj.has_jpg() else img_obj.nef_file)}"
+            self.canvas.itemconfigure(tile.text_id, text=caption, state=ctk.NORMAL)
+            self.canvas.itemconfigure(tile.rect_id, state=ctk.NORMAL)
+
+        self.canvas.itemconfigure(tile.rect_id, outline="#1f6aa5" if img_obj in self._selected else "")
+
+        if tile.key == img_obj.filename:
+            self.canvas.itemconfigure(tile.image_id, state=ctk.NORMAL)
+            return
+
+        preview = self._cache.get(img_obj)
+        if preview is None:
+            tile.key = None
+            self.canvas.itemconfigure(tile.image_id, state=ctk.HIDDEN)
+            self._cache.request(img_obj)
+        else:
+            tile.photo.paste(preview)
+            tile.key = img_obj.filename
+            self.canvas.itemconfigure(tile.image_id, state=ctk.NORMAL)
+
+    def _poll(self):
+        keys = set(self._cache.poll())
+        if keys:
+            for index in list(self._tiles):
+                if self._items[index].filename in keys:
+                    self._place(index)
+        self._poll_job = self.after(30, self._poll)
+
+    # -------------------------------------------------------------------------------
+    # Selection
+    # -------------------------------------------------------------------------------
+
+    def _index_at(self, event) -> Optional[int]:
+        col = int(self.canvas.canvasx(event.x) // self._tile_w)
+        index = int(self.canvas.canvasy(event.y) // self._tile_h) * self._cols + col
+        if col >= self._cols or index >= len(self._items):
+            return None
+        return index
+
+    def _click(self, event):
+        index = self._index_at(event)
+        if index is None:
+            return
+
+        if event.state & 0x1 and self._anchor is not None:  # Shift
+            lo, hi = sorted((self._anchor, index))
+            self._selected = set(self._items[lo:hi + 1])
+        elif event.state & 0x4:  # Control
+            self._selected ^= {self._items[index]}
+            self._anchor = index
+        else:
+            self._selected = {self._items[index]}
+            self._anchor = index
+        self._refresh()
+
+    def _double_click(self, event):
+        index = self._index_at(event)
+        if index is not None:
+            self._on_open(self._items[index])
+
+    def _bulk(self, op: str):
+        skipped = 0
+        self._cache.wait({img_obj.filename for img_obj in self._selected})
+        for img_obj in sorted(self._selected, key=lambda x: self._index[x]):
+            if (op == "op_keep_jpg" and not img_obj.has_jpg()) or (op == "op_keep_nef" and not img_obj.has_nef()):
+                skipped += 1
+                continue
+            self._img_it.select_img(img_obj)
+            getattr(self._img_it, op)()
+
+        self._selected.clear()
+        if skipped:
+            msg = CTkMessagebox(title="Info", message=f"Skipped {skipped} image(s) without the file to keep.",
+                                icon="info")
+            msg.get()
+
+        if self._img_it.curr_img() is None:
+            self._on_close()
+        else:
+            self.reload()